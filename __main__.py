@@ -1,7 +1,10 @@
 """A Google Cloud Python Pulumi program"""
 import base64
 import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 
 import pulumi
 from pulumi_gcp import cloudfunctions, cloudscheduler, pubsub, serviceaccount, storage
@@ -9,6 +12,10 @@ from pulumi_gcp import cloudfunctions, cloudscheduler, pubsub, serviceaccount, s
 from utils import iam_service_account, secret, secret_binding
 
 PATH_TO_SOURCE_CODE = "./functions"
+HASH_CHUNK_SIZE = 1 << 20
+HASH_CACHE_PATH = ".pulumi/archive_hash_cache.json"
+# Bump to invalidate cached file digests and previously computed archive hashes.
+HASH_VERSION = "1"
 
 config = pulumi.Config(name=None)
 
@@ -41,8 +48,8 @@ topic = pubsub.Topic("trigger")
 job = cloudscheduler.Job(
     "job",
     pubsub_target=cloudscheduler.JobPubsubTargetArgs(
-        topic_name=pulumi.Output.all(topic.project, topic.name).apply(
-            lambda args: f"projects/{args[0]}/topics/{args[1]}"
+        topic_name=pulumi.Output.concat(
+            "projects/", topic.project, "/topics/", topic.name
         ),
         data=base64.b64encode(b"refresh").decode("utf8"),
     ),
@@ -62,32 +69,79 @@ storage.BucketIAMBinding(
 )
 
 
+def file_hash(path: str) -> bytes:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+
+    return hasher.digest()
+
+
+def load_hash_cache() -> Dict[str, str]:
+    try:
+        with open(HASH_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_hash_cache(cache: Dict[str, str]) -> None:
+    os.makedirs(os.path.dirname(HASH_CACHE_PATH), exist_ok=True)
+    with open(HASH_CACHE_PATH, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
 def archive_hash(archive: pulumi.AssetArchive) -> str:
-    hasher = hashlib.sha1()
-    for asset in archive.assets.values():
+    cache = load_hash_cache()
+    keys = {}
+    digests = {}
+    stale = {}
+    for name, asset in archive.assets.items():
         assert isinstance(asset, pulumi.FileAsset)
-        with open(asset.path, "rb") as f:
-            hasher.update(f.read())
+        st = os.stat(asset.path)
+        keys[name] = f"{HASH_VERSION}:{asset.path}:{st.st_mtime_ns}:{st.st_size}"
+        if keys[name] in cache:
+            digests[name] = bytes.fromhex(cache[keys[name]])
+        else:
+            stale[name] = asset.path
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            digests.update(zip(stale, executor.map(file_hash, stale.values())))
+        save_hash_cache({keys[name]: digests[name].hex() for name in keys})
+
+    hasher = hashlib.sha256(HASH_VERSION.encode("utf8"))
+    for name, digest in sorted(digests.items()):
+        hasher.update(name.encode("utf8"))
+        hasher.update(digest)
 
     return hasher.hexdigest()
 
 
 # The Cloud Function source code itself needs to be zipped up into an
 # archive, which we create using the pulumi.AssetArchive primitive.
-archive = pulumi.AssetArchive(
-    assets={
-        file: pulumi.FileAsset(path=os.path.join(PATH_TO_SOURCE_CODE, file))
-        for file in os.listdir(PATH_TO_SOURCE_CODE)
-    }
-)
+# Only regular files are packaged, which also keeps __pycache__ and any stray
+# bytecode out of the upload.
+with os.scandir(PATH_TO_SOURCE_CODE) as entries:
+    archive = pulumi.AssetArchive(
+        assets={
+            entry.name: pulumi.FileAsset(path=entry.path)
+            for entry in entries
+            if entry.is_file() and not entry.name.endswith(".pyc")
+        }
+    )
+
+source_hash = archive_hash(archive)
 
 # Create the single Cloud Storage object, which contains all of the function's
 # source code. ("main.py" and "requirements.txt".)
 source_archive_object = storage.BucketObject(
     "things",
-    name=f"main.py-{archive_hash(archive)}",
+    name=f"main.py-{source_hash}",
     bucket=code_bucket.name,
     source=archive,
+    metadata={"archive_hash": source_hash},
 )
 
 # Create the Cloud Function, deploying the source we just uploaded to Google
@@ -102,7 +156,7 @@ fxn = cloudfunctions.Function(
         "THINGS_BUCKET_NAME": data_bucket.name,
     },
     region="europe-west1",
-    runtime="python37",
+    runtime="python39",
     service_account_email=account.email,
     source_archive_bucket=code_bucket.name,
     source_archive_object=source_archive_object.name,
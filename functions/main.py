@@ -1,12 +1,22 @@
+from __future__ import annotations
+
+import concurrent.futures
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import os
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, Optional
 
-import gkeepapi
 from google.api_core.exceptions import NotFound
-from google.cloud import secretmanager, storage
+from google.cloud import secretmanager
+
+# gkeepapi and google.cloud.storage are imported where they are first used, so
+# their import time is spent in the first invocation rather than at module load.
+if TYPE_CHECKING:
+    import gkeepapi
+    from google.cloud import storage
 
 secrets_client = secretmanager.SecretManagerServiceClient()
 
@@ -19,8 +29,28 @@ GKEEP_PASSWORD_KEY = os.environ["GKEEP_PASSWORD_KEY"]
 GKEEP_TOKEN_KEY = os.environ["GKEEP_TOKEN_KEY"]
 GCP_PROJECT = os.environ["GCP_PROJECT"]
 
-GKeepList = gkeepapi._node.List
-GKeepListItem = gkeepapi._node.ListItem
+KEEP_TTL = datetime.timedelta(minutes=30)
+# Note that this holds every note in the Keep account, including shared notes,
+# not just the shopping list. A dump limited to the shopping note cannot be
+# restored safely: gkeepapi attaches synced changes to their parent node, so
+# the first change to any other list would fail the incremental sync.
+KEEP_STATE_BLOB = "keep/state.json"
+KEEP_STATE_SAVE_INTERVAL = datetime.timedelta(days=1)
+
+# Warm instances are reused between scheduler fires, so hold on to the
+# logged in Keep client rather than resuming each time.
+_keep: Optional[gkeepapi.Keep] = None
+_keep_refreshed_at: Optional[datetime.datetime] = None
+# The dumped state is also saved to the bucket daily so cold starts can
+# restore it before resuming.
+_keep_state_saved_at: Optional[datetime.datetime] = None
+
+# Server ID of the shopping note, to avoid searching every note on each fire.
+_shopping_id: Optional[str] = None
+
+# Hash of the last uploaded list, so unchanged lists need neither a download
+# nor a metadata lookup once known.
+_latest_sha256: Optional[str] = None
 
 
 def _secret_path(name: str) -> str:
@@ -36,15 +66,32 @@ def get_secret(
     request = {"name": f"{_secret_path(name)}/versions/latest"}
     try:
         if age_limit:
-            secret = client.get_secret_version(request)
-            age = datetime.datetime.now(datetime.timezone.utc) - secret.create_time
-            if age > age_limit:
-                return None
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                version = executor.submit(client.get_secret_version, request)
+                access = executor.submit(client.access_secret_version, request)
+                age = (
+                    datetime.datetime.now(datetime.timezone.utc)
+                    - version.result().create_time
+                )
+                if age > age_limit:
+                    return None
+                return access.result().payload.data.decode("utf8")  # type: ignore
         return client.access_secret_version(request).payload.data.decode("utf8")  # type: ignore
     except NotFound:
         return None
 
 
+def get_secrets(
+    client: secretmanager.SecretManagerServiceClient, *names: str
+) -> Dict[str, Optional[str]]:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = {executor.submit(get_secret, client, name): name for name in names}
+        return {
+            futures[future]: future.result()
+            for future in concurrent.futures.as_completed(futures)
+        }
+
+
 def add_secret_version(
     client: secretmanager.SecretManagerServiceClient, name: str, value: str
 ) -> None:
@@ -55,61 +102,178 @@ def add_secret_version(
     client.add_secret_version(request)  # type: ignore
 
 
-GKEEP_USERNAME = get_secret(secrets_client, GKEEP_USERNAME_KEY)
-GKEEP_PASSWORD = get_secret(secrets_client, GKEEP_PASSWORD_KEY)
+_secrets = get_secrets(secrets_client, GKEEP_USERNAME_KEY, GKEEP_PASSWORD_KEY)
+GKEEP_USERNAME = _secrets[GKEEP_USERNAME_KEY]
+GKEEP_PASSWORD = _secrets[GKEEP_PASSWORD_KEY]
 
 
-def login() -> gkeepapi.Keep:
-    keep = gkeepapi.Keep()
+@functools.lru_cache(maxsize=None)
+def get_things_bucket() -> storage.Bucket:
+    from google.cloud import storage
+
+    return storage.Client().bucket(THINGS_BUCKET_NAME)
+
+
+def authenticate(keep: gkeepapi.Keep) -> None:
+    import gkeepapi
 
     token = get_secret(
         secrets_client, GKEEP_TOKEN_KEY, age_limit=datetime.timedelta(days=1)
     )
     try:
-        if token and keep.resume(GKEEP_USERNAME, token):
+        if token and keep.resume(GKEEP_USERNAME, token, sync=False):
             _logger.info("login resumed")
-            return keep
+            return
     except gkeepapi.exception.LoginException:
         _logger.warning("login resume failed")
 
-    if keep.login(GKEEP_USERNAME, GKEEP_PASSWORD):
+    if keep.login(GKEEP_USERNAME, GKEEP_PASSWORD, sync=False):
         _logger.info("new login")
         add_secret_version(secrets_client, GKEEP_TOKEN_KEY, keep.getMasterToken())
-        return keep
+        return
 
     raise ValueError("failed login")
 
 
+def login(state: Optional[dict] = None) -> gkeepapi.Keep:
+    import gkeepapi
+
+    keep = gkeepapi.Keep()
+    authenticate(keep)
+
+    # Keep.login/resume clear any restored state when they sync, so restore
+    # here and only pull the changes since the dump.
+    if state is not None:
+        try:
+            keep.restore(state)
+            keep.sync()
+            _logger.info("keep state restored")
+            return keep
+        except (
+            KeyError,
+            gkeepapi.exception.ParseException,
+            gkeepapi.exception.ResyncRequiredException,
+        ):
+            _logger.warning("keep state restore failed", exc_info=True)
+
+    keep.sync(True)
+    return keep
+
+
+def load_keep_state() -> Optional[dict]:
+    global _keep_state_saved_at
+
+    try:
+        blob = get_things_bucket().get_blob(KEEP_STATE_BLOB)
+        if blob is None:
+            return None
+        state = json.loads(blob.download_as_text())
+    except Exception:
+        _logger.warning("loading keep state failed", exc_info=True)
+        return None
+    _keep_state_saved_at = blob.updated
+    return state
+
+
+def save_keep_state(keep: gkeepapi.Keep, now: datetime.datetime) -> None:
+    global _keep_state_saved_at
+
+    if (
+        _keep_state_saved_at is not None
+        and now - _keep_state_saved_at < KEEP_STATE_SAVE_INTERVAL
+    ):
+        return
+    try:
+        get_things_bucket().blob(KEEP_STATE_BLOB).upload_from_string(
+            json.dumps(keep.dump()), content_type="application/json"
+        )
+    except Exception:
+        _logger.warning("saving keep state failed", exc_info=True)
+        return
+    _keep_state_saved_at = now
+    _logger.info("keep state saved")
+
+
+def get_keep() -> gkeepapi.Keep:
+    global _keep, _keep_refreshed_at
+
+    import gkeepapi
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    synced = False
+    if (
+        _keep is not None
+        and _keep_refreshed_at is not None
+        and now - _keep_refreshed_at < KEEP_TTL
+    ):
+        try:
+            _keep.sync()
+            _logger.info("login reused")
+            synced = True
+        except (gkeepapi.exception.APIException, gkeepapi.exception.KeepException):
+            _logger.warning("cached login sync failed")
+
+    if not synced:
+        state = _keep.dump() if _keep is not None else load_keep_state()
+        _keep = login(state)
+        _keep_refreshed_at = now
+
+    save_keep_state(_keep, now)
+    return _keep
+
+
 def upload(payload: str) -> None:
-    client = storage.Client()
-    bucket = client.bucket(THINGS_BUCKET_NAME)
+    global _latest_sha256
+
+    bucket = get_things_bucket()
     latest = bucket.blob("unchecked/latest.json")
-    try:
-        old_items_text = latest.download_as_text()
-    except NotFound:
-        old_items_text = None
+    payload_sha256 = hashlib.sha256(payload.encode("utf8")).hexdigest()
+    if _latest_sha256 is None:
+        try:
+            latest.reload()
+            _latest_sha256 = (latest.metadata or {}).get("content_sha256")
+        except NotFound:
+            pass
 
-    if old_items_text != payload:
+    if _latest_sha256 != payload_sha256:
         _logger.info(f"uploading new list {payload}")
-        latest.upload_from_string(payload)
+        latest.metadata = {"content_sha256": payload_sha256}
+        latest.cache_control = "no-cache"
         stamp = datetime.datetime.now(datetime.timezone.utc).isoformat()[:-13]
         history = bucket.blob(f"unchecked/history/{stamp}.json")
-        history.upload_from_string(payload)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(
+                    latest.upload_from_string, payload, content_type="application/json"
+                ),
+                executor.submit(
+                    history.upload_from_string, payload, content_type="application/json"
+                ),
+            ]
+            for future in futures:
+                future.result()
+        _latest_sha256 = payload_sha256
     else:
         _logger.info("no change")
 
 
+def find_shopping(keep: gkeepapi.Keep) -> gkeepapi._node.List:
+    global _shopping_id
+
+    shopping = keep.get(_shopping_id) if _shopping_id else None
+    if shopping is None or shopping.trashed:
+        shopping = next(keep.find(query="Shopping"))
+        _shopping_id = shopping.id
+    return shopping
+
+
 def main() -> None:
-    keep = login()
-    shopping = next(keep.find(query="Shopping"))
-
-    items = [
-        item
-        for item in {item.text.strip().lower() for item in shopping.unchecked}
-        if item
-    ]
-    items.sort()
-    items_text = json.dumps(items)
+    keep = get_keep()
+    shopping = find_shopping(keep)
+
+    texts = (item.text.strip().lower() for item in shopping.unchecked)
+    items = sorted({text for text in texts if text})
+    items_text = json.dumps(items, separators=(",", ":"), ensure_ascii=False)
 
     upload(items_text)
 